@@ -32,18 +32,26 @@ export async function POST(request: NextRequest) {
     );
     const pythonExecutable = fs.existsSync(venvPython) ? venvPython : "python3";
 
+    // Run as a module of the python package so that every pipeline module,
+    // the entry point included, shares one copy of shared_types
     const pythonProcess = spawn(
       pythonExecutable,
-      [
-        path.join(process.cwd(), "src/server/python/group_flows.py"),
-        JSON.stringify(batch),
-      ],
+      ["-m", "python.group_flows"],
       {
-        cwd: path.join(process.cwd(), "src/server/python"),
+        cwd: path.join(process.cwd(), "src/server"),
         stdio: ["pipe", "pipe", "pipe"],
       },
     );
 
+    // A child that exits before draining stdin fails the write with EPIPE;
+    // without a listener that error would crash the server
+    pythonProcess.stdin?.on("error", (error) => {
+      console.error(`[Python stdin] Error: ${error.message}`);
+    });
+
+    // Stream the batch through stdin; large batches exceed argv size limits
+    pythonProcess.stdin?.end(JSON.stringify(batch));
+
     // Set up output piping without waiting for completion
     pythonProcess.stdout?.on("data", (data: Buffer) => {
       const dataString = data.toString();
@@ -18,10 +18,15 @@ export const workflows = createTable(
     id: d.integer().primaryKey().generatedByDefaultAsIdentity(),
     summary: d.text().notNull(),
     steps: d.jsonb().notNull(),
+    // Sorted, comma-joined tool names; duplicate workflows share a signature
+    toolSignature: d.text("tool_signature"),
     createdAt: d
       .timestamp({ withTimezone: true })
       .default(sql`CURRENT_TIMESTAMP`)
       .notNull(),
   }),
-  (t) => [index("summary_idx").on(t.summary)],
+  (t) => [
+    index("summary_idx").on(t.summary),
+    index("tool_signature_idx").on(t.toolSignature),
+  ],
 );
@@ -1,31 +1,89 @@
 """Main orchestrator for workflow processing from browser events."""
 
+import os
 import sys
 import json
-from tab_sessions import group_events_into_tab_sessions
-from workflow_processing import process_workflows_from_tab_sessions
-from workflow_analysis import analyze_and_update_workflows, save_workflows_to_database
+import asyncio
+import logging
+import logging.handlers
+import queue
+from typing import Dict, List
+from .shared_types import close_async_anthropic_client
+from .tab_sessions import group_events_into_tab_sessions
+from .workflow_processing import process_workflows_from_tab_sessions
+from .workflow_analysis import (
+    analyze_and_update_workflows,
+    close_database_pool,
+    fetch_tool_signatures,
+    save_workflows_to_database,
+)
 
+logger = logging.getLogger(__name__)
 
-def main():
-    batch_json = sys.argv[1]
-    batch_data = json.loads(batch_json)
 
-    # Step 1: Group events into tab sessions
-    tab_group_summaries = group_events_into_tab_sessions(batch_data["events"])
-    print("tab_group_summaries", tab_group_summaries)
+async def run_pipeline(events: List[Dict]) -> None:
+    try:
+        # Step 1: Group events into tab sessions
+        tab_group_summaries = await group_events_into_tab_sessions(events)
+        logger.info("Grouped events into %d tab sessions", len(tab_group_summaries))
+        logger.debug("tab_group_summaries %s", tab_group_summaries)
+
+        # Step 2: Process tab sessions to identify workflows
+        workflows = await process_workflows_from_tab_sessions(tab_group_summaries)
+        logger.info("Identified %d workflows", len(workflows))
+        logger.debug("workflows %s", workflows)
+
+        # Step 3: Analyze workflows for tool usage and filter, while the
+        # stored tool signatures are fetched in a worker thread
+        existing_signatures, final_workflows = await asyncio.gather(
+            asyncio.to_thread(fetch_tool_signatures),
+            analyze_and_update_workflows(workflows),
+        )
+        logger.info("%d workflows remain after tool analysis", len(final_workflows))
+        logger.debug("final_workflows %s", final_workflows)
+
+        # Save to database
+        save_workflows_to_database(final_workflows, existing_signatures)
+        logger.info("Processing complete")
+    finally:
+        # The async client's connections belong to this event loop
+        await close_async_anthropic_client()
+        close_database_pool()
+
 
-    # Step 2: Process tab sessions to identify workflows
-    workflows = process_workflows_from_tab_sessions(tab_group_summaries)
-    print("workflows", workflows)
+def configure_logging() -> logging.handlers.QueueListener:
+    """
+    Route log records through a queue to a listener thread, so the event
+    loop never blocks on writing them out.
+    """
+    log_queue: queue.SimpleQueue = queue.SimpleQueue()
+    handler = logging.StreamHandler()
+    handler.setFormatter(logging.Formatter(logging.BASIC_FORMAT))
+
+    root = logging.getLogger()
+    root.setLevel(os.getenv("LOG_LEVEL", "INFO"))
+    root.addHandler(logging.handlers.QueueHandler(log_queue))
+
+    listener = logging.handlers.QueueListener(log_queue, handler)
+    listener.start()
+    return listener
+
+
+def main():
+    listener = configure_logging()
 
-    # Step 3: Analyze workflows for tool usage and filter
-    final_workflows = analyze_and_update_workflows(workflows)
-    print("final_workflows", final_workflows)
+    # The batch is piped through stdin: a single argv entry is capped at
+    # 128KB on Linux, which page markdown easily exceeds. An argv payload
+    # is still accepted for manual runs.
+    if len(sys.argv) > 1:
+        batch_data = json.loads(sys.argv[1])
+    else:
+        batch_data = json.load(sys.stdin.buffer)
 
-    # Save to database
-    save_workflows_to_database(final_workflows)
-    print("✅ Processing complete!")
+    try:
+        asyncio.run(run_pipeline(batch_data["events"]))
+    finally:
+        listener.stop()
 
 
 if __name__ == "__main__":
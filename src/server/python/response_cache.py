@@ -0,0 +1,99 @@
+"""Response cache for Claude summaries, kept in memory and persisted across runs."""
+
+import os
+import sqlite3
+import time
+from typing import Dict, Optional
+
+CACHE_PATH = os.getenv(
+    "RESPONSE_CACHE_PATH",
+    os.path.join(
+        os.path.expanduser("~"), ".cache", "workflow-handler", "responses.sqlite3"
+    ),
+)
+CACHE_TTL = 7 * 24 * 60 * 60  # seconds
+CACHE_MAX_BYTES = 1024**3  # Past this, the entries closest to expiry are culled
+
+_memory: Dict[str, str] = {}
+_conn: Optional[sqlite3.Connection] = None
+_disabled = False  # Set when the cache file can't be opened; memory-only then
+
+
+def _live_bytes(conn: sqlite3.Connection) -> int:
+    """Bytes in use by the cache; free pages left by deletes don't count."""
+    page_count = conn.execute("PRAGMA page_count").fetchone()[0]
+    freelist_count = conn.execute("PRAGMA freelist_count").fetchone()[0]
+    page_size = conn.execute("PRAGMA page_size").fetchone()[0]
+    return (page_count - freelist_count) * page_size
+
+
+def _get_connection() -> Optional[sqlite3.Connection]:
+    global _conn, _disabled
+    if _conn is None and not _disabled:
+        try:
+            os.makedirs(os.path.dirname(CACHE_PATH), exist_ok=True)
+            conn = sqlite3.connect(CACHE_PATH)
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS responses (
+                    key TEXT PRIMARY KEY,
+                    value TEXT NOT NULL,
+                    expires_at REAL NOT NULL
+                )
+                """)
+            conn.execute("DELETE FROM responses WHERE expires_at < ?", (time.time(),))
+            culled = False
+            if _live_bytes(conn) > CACHE_MAX_BYTES:
+                conn.execute("""
+                    DELETE FROM responses WHERE key IN (
+                        SELECT key FROM responses ORDER BY expires_at
+                        LIMIT (SELECT COUNT(*) / 2 FROM responses)
+                    )
+                    """)
+                culled = True
+            conn.commit()
+            if culled:
+                # Deleted rows only become free pages; VACUUM returns them
+                conn.execute("VACUUM")
+            _conn = conn
+        except (OSError, sqlite3.Error):
+            _disabled = True
+    return _conn
+
+
+def get_cached_response(key: str) -> Optional[str]:
+    """Look a response up in memory first, then in the persistent cache."""
+    if key in _memory:
+        return _memory[key]
+
+    conn = _get_connection()
+    if conn is None:
+        return None
+    try:
+        row = conn.execute(
+            "SELECT value FROM responses WHERE key = ? AND expires_at >= ?",
+            (key, time.time()),
+        ).fetchone()
+    except sqlite3.Error:
+        return None
+
+    if row is None:
+        return None
+    _memory[key] = row[0]
+    return row[0]
+
+
+def set_cached_response(key: str, value: str) -> None:
+    """Store a response in memory and persist it for CACHE_TTL seconds."""
+    _memory[key] = value
+
+    conn = _get_connection()
+    if conn is None:
+        return
+    try:
+        conn.execute(
+            "INSERT OR REPLACE INTO responses (key, value, expires_at) VALUES (?, ?, ?)",
+            (key, value, time.time() + CACHE_TTL),
+        )
+        conn.commit()
+    except sqlite3.Error:
+        pass
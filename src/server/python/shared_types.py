@@ -1,10 +1,57 @@
 """Shared types and utilities for workflow processing."""
 
 import os
+import math
+import re
+import random
+import asyncio
+import functools
 from dataclasses import dataclass
-from typing import List, Optional
+from typing import Dict, List, Optional, Set
 from enum import Enum
-from anthropic import Anthropic
+import httpx
+from anthropic import (
+    APIConnectionError,
+    APIStatusError,
+    AsyncAnthropic,
+    DefaultAsyncHttpxClient,
+)
+from anthropic.types import Message
+
+# Haiku for the bounded-length page/activity summaries; Sonnet where the
+# classification quality matters
+SUMMARY_MODEL = "claude-3-5-haiku-20241022"
+SUMMARY_MAX_TOKENS = 600  # Viewport + activity summaries, ~250 words combined
+CLASSIFIER_MODEL = "claude-sonnet-4-20250514"
+
+# Upper bound on in-flight Claude requests when fanning out with asyncio
+MAX_CONCURRENT_REQUESTS = 8
+
+# Connection pool of the shared async client; HTTP/2 lets concurrent
+# requests multiplex over a few connections instead of opening one each
+HTTP_MAX_CONNECTIONS = 64
+HTTP_MAX_KEEPALIVE_CONNECTIONS = 32
+HTTP_TIMEOUT = 60.0  # seconds
+API_MAX_RETRIES = 3
+
+# create_message turns off the client's own retries and retries what the SDK
+# would itself (connection errors, 408/409/429/5xx incl. 529 overloaded, or
+# whatever x-should-retry says): it honors retry-after and otherwise backs
+# off with randomized exponential waits, so concurrent callers spread out.
+# RATE_LIMIT_MAX_ATTEMPTS counts HTTP requests.
+RATE_LIMIT_MAX_ATTEMPTS = 6
+RATE_LIMIT_BASE_WAIT = 1.0  # seconds; ceiling of the first backoff
+RATE_LIMIT_MAX_WAIT = 30.0  # cap on backoff
+RATE_LIMIT_MAX_RETRY_AFTER = 60.0  # cap on a server-sent retry-after
+
+# Below this many requests the Message Batches API isn't worth its latency
+BATCH_MIN_REQUESTS = 20
+BATCH_POLL_INTERVAL = 10  # seconds, doubled after every poll
+BATCH_MAX_POLL_INTERVAL = 120
+BATCH_MAX_WAIT = 60 * 60  # seconds; batches can take up to 24h, callers can't
+
+# scheme://host prefix of a URL, up to the first "/" after the "://"
+_BASE_URL_RE = re.compile(r"^(.*?://[^/]*)")
 
 
 @dataclass
@@ -14,6 +61,7 @@ class TabSessionSummary:
     activity_summary: str  # Analysis of the full tab group activities
     events_count: int
     tab_id: Optional[int] = None
+    event_types: Optional[Set[str]] = None  # Distinct event types in the group
 
 
 @dataclass
@@ -37,6 +85,135 @@ class DeterminerResponse(Enum):
     UNFINISHED = "unfinished"  # Part of workflow but needs more data
 
 
-def get_anthropic_client():
-    api_key = os.getenv("ANTHROPIC_API_KEY")
-    return Anthropic(api_key=api_key)
+@functools.lru_cache(maxsize=8192)
+def get_base_url(url):
+    if not url:
+        return None
+
+    match = _BASE_URL_RE.match(url)
+    return match.group(1) if match else url.split("/", 1)[0]
+
+
+# The client is created once per process so its connection pool is reused
+_async_client: Optional[AsyncAnthropic] = None
+
+
+def get_async_anthropic_client() -> AsyncAnthropic:
+    global _async_client
+    if _async_client is None:
+        _async_client = AsyncAnthropic(
+            api_key=os.getenv("ANTHROPIC_API_KEY"),
+            http_client=DefaultAsyncHttpxClient(
+                http2=True,
+                limits=httpx.Limits(
+                    max_connections=HTTP_MAX_CONNECTIONS,
+                    max_keepalive_connections=HTTP_MAX_KEEPALIVE_CONNECTIONS,
+                ),
+                timeout=HTTP_TIMEOUT,
+            ),
+            max_retries=API_MAX_RETRIES,
+        )
+    return _async_client
+
+
+async def close_async_anthropic_client() -> None:
+    """Close the shared async client; must run on the loop that used it."""
+    global _async_client
+    if _async_client is not None:
+        await _async_client.close()
+        _async_client = None
+
+
+# Status codes the SDK retries: timeout, lock conflict, rate limit; plus 5xx
+_RETRYABLE_STATUS_CODES = {408, 409, 429}
+
+
+def _should_retry(error: Exception) -> bool:
+    """Whether a failed request is transient, using the SDK's retry rules."""
+    if isinstance(error, APIConnectionError):
+        return True  # Includes timeouts
+    should_retry = error.response.headers.get("x-should-retry")
+    if should_retry in ("true", "false"):
+        return should_retry == "true"
+    status = error.status_code
+    return status in _RETRYABLE_STATUS_CODES or status >= 500
+
+
+def _rate_limit_delay(error: Exception, attempt: int) -> float:
+    """Seconds to wait before retrying: retry-after if given, else jittered."""
+    response = getattr(error, "response", None)
+    retry_after = response.headers.get("retry-after") if response else None
+    if retry_after is not None:
+        try:
+            seconds = float(retry_after)
+        except ValueError:
+            seconds = math.nan
+        # "inf"/"nan" parse as floats but aren't waits; fall back to backoff
+        if math.isfinite(seconds):
+            return min(max(seconds, 0.0), RATE_LIMIT_MAX_RETRY_AFTER)
+    # Full jitter: waits start anywhere from zero so callers don't retry in step
+    ceiling = min(RATE_LIMIT_MAX_WAIT, RATE_LIMIT_BASE_WAIT * 2**attempt)
+    return random.uniform(0.0, ceiling)
+
+
+async def create_message(**params) -> Message:
+    """
+    messages.create on the shared async client, retrying transient errors.
+
+    The client's built-in retries are disabled for these calls so that every
+    attempt, and every wait between attempts, happens here.
+
+    Raises:
+        APIStatusError, APIConnectionError: right away if the error isn't
+            transient, else if the last of RATE_LIMIT_MAX_ATTEMPTS fails
+    """
+    client = get_async_anthropic_client().with_options(max_retries=0)
+    for attempt in range(RATE_LIMIT_MAX_ATTEMPTS - 1):
+        try:
+            return await client.messages.create(**params)
+        except (APIConnectionError, APIStatusError) as e:
+            if not _should_retry(e):
+                raise
+            await asyncio.sleep(_rate_limit_delay(e, attempt))
+    return await client.messages.create(**params)
+
+
+async def run_message_batch(requests: List[Dict]) -> Dict[str, Message]:
+    """
+    Submit requests through the Message Batches API and wait for the results.
+
+    Args:
+        requests: Batch requests of the form {"custom_id": ..., "params": ...}
+
+    Returns:
+        Dict mapping custom_id to its message; failed requests are omitted
+
+    Raises:
+        TimeoutError: if the batch hasn't ended after BATCH_MAX_WAIT seconds;
+            it is cancelled first
+    """
+    if not requests:
+        return {}
+
+    client = get_async_anthropic_client()
+    batch = await client.messages.batches.create(requests=requests)  # type: ignore
+
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + BATCH_MAX_WAIT
+    delay = BATCH_POLL_INTERVAL
+    while batch.processing_status != "ended":
+        if loop.time() >= deadline:
+            try:
+                await client.messages.batches.cancel(batch.id)
+            except Exception:
+                pass  # The batch expires on its own; cancelling just frees it early
+            raise TimeoutError(f"Message batch {batch.id} did not end in time")
+        await asyncio.sleep(min(delay, max(deadline - loop.time(), 0)))
+        delay = min(delay * 2, BATCH_MAX_POLL_INTERVAL)
+        batch = await client.messages.batches.retrieve(batch.id)
+
+    messages = {}
+    async for entry in await client.messages.batches.results(batch.id):
+        if entry.result.type == "succeeded":
+            messages[entry.custom_id] = entry.result.message
+    return messages
@@ -1,202 +1,513 @@
 """Module for grouping browser events into tab sessions."""
 
-from typing import List, Dict, Optional
-from .shared_types import TabSessionSummary, get_anthropic_client
-
-
-def get_base_url(url):
-    if not url:
-        return None
-
-    if "://" in url:
-        return url.split("://")[0] + "://" + url.split("://")[1].split("/")[0]
-    return url.split("/")[0]
+import asyncio
+import hashlib
+import json
+import logging
+import re
+from collections import OrderedDict
+from dataclasses import dataclass
+from itertools import islice
+from typing import List, Dict, Optional, Tuple
+from anthropic.types import Message
+from .response_cache import get_cached_response, set_cached_response
+from .shared_types import (
+    BATCH_MIN_REQUESTS,
+    MAX_CONCURRENT_REQUESTS,
+    SUMMARY_MAX_TOKENS,
+    SUMMARY_MODEL,
+    TabSessionSummary,
+    create_message,
+    get_base_url,
+    run_message_batch,
+)
+
+logger = logging.getLogger(__name__)
+
+# Static instruction prefix and tool schema, sent ahead of the per-group
+# content so Anthropic's prompt cache can reuse them across groups.
+SUMMARIZE_GROUP_INSTRUCTIONS = """Summarize this browser tab session by calling summarize_group with:
+- viewport: a concise summary of the web page content(s). Focus on the main topics, key information, and overall purpose. Keep it under 150 words.
+- activity: a concise activity summary (under 100 words) of the user events. Focus on what the user was doing, their intent, and the nature of their interaction."""
+
+SUMMARIZE_GROUP_TOOL = {
+    "name": "summarize_group",
+    "description": "Record the viewport and activity summaries of a tab session",
+    "input_schema": {
+        "type": "object",
+        "properties": {
+            "viewport": {
+                "type": "string",
+                "description": "Summary of the page content(s), under 150 words",
+            },
+            "activity": {
+                "type": "string",
+                "description": "Summary of the user's activity, under 100 words",
+            },
+        },
+        "required": ["viewport", "activity"],
+    },
+    "cache_control": {"type": "ephemeral"},
+}
+
+# Prompt size caps: summaries are prefill-bound, so page content is cut to a
+# token budget shared across the group's pages and long event streams are
+# cut off before being sent. A token here averages ~4.5 characters, so a page
+# gets at most ~4k characters and a prompt ~9k.
+MAX_PAGE_TOKENS_PER_PROMPT = 2000
+MAX_TOKENS_PER_PAGE = 900
+MAX_EVENTS_PER_PROMPT = 200
+
+# Local approximation of the tokenizer: words and individual punctuation marks.
+# Token-dense content (code, URLs) counts as many tokens, prose as few.
+_TOKEN_RE = re.compile(r"\w+|[^\w\s]")
+
+
+# Cut points of recently truncated pages, keyed by page hash and budget so the
+# cache holds two ints per entry rather than the pages themselves
+TOKEN_CUT_CACHE_SIZE = 1024
+_token_cuts: "OrderedDict[Tuple[bytes, int], Tuple[int, int]]" = OrderedDict()
+
+
+def _truncate_to_tokens(markdown: str, budget: int) -> Tuple[str, int]:
+    """Cut a page to at most `budget` tokens, returning it and the tokens used."""
+    if budget <= 0:
+        return "", 0
+    key = (hashlib.sha1(markdown.encode("utf-8")).digest(), budget)
+    cut = _token_cuts.get(key)
+    if cut is not None:
+        _token_cuts.move_to_end(key)
+    else:
+        # Only scan one token past the budget, not the whole page
+        matches = list(islice(_TOKEN_RE.finditer(markdown), budget + 1))
+        if len(matches) <= budget:
+            cut = (len(markdown), len(matches))
+        else:
+            cut = (matches[budget - 1].end(), budget)
+        _token_cuts[key] = cut
+        if len(_token_cuts) > TOKEN_CUT_CACHE_SIZE:
+            _token_cuts.popitem(last=False)
+    end, used = cut
+    return markdown[:end], used
 
 
-def summarize_markdowns(markdowns: List[str]) -> str:
-    """Create a concise summary of markdown content from multiple pages."""
-    if not markdowns:
-        return "No content available"
-
-    client = get_anthropic_client()
+def _prepare_markdowns(markdowns: List[str]) -> List[str]:
+    """
+    Drop pages that repeat an earlier one (ignoring case and whitespace) and
+    fit the rest to the token budget.
 
+    Each page gets an even share of what is left of the budget, up to
+    MAX_TOKENS_PER_PAGE, so tokens a short page doesn't use roll over to the
+    pages after it.
+    """
+    unique = []
+    seen_pages = set()
+    for markdown in markdowns:
+        # Hash the whole page: pages of one site share their header and
+        # navigation, so a prefix would conflate distinct pages
+        normalized = " ".join(markdown.split()).lower()
+        digest = hashlib.sha1(normalized.encode("utf-8")).digest()
+        if digest in seen_pages:
+            continue
+        seen_pages.add(digest)
+        unique.append(markdown)
+
+    prepared = []
+    remaining = MAX_PAGE_TOKENS_PER_PROMPT
+    for i, markdown in enumerate(unique):
+        if remaining <= 0:
+            break
+        share = min(remaining // (len(unique) - i), MAX_TOKENS_PER_PAGE)
+        truncated, used = _truncate_to_tokens(markdown, share)
+        if truncated:
+            prepared.append(truncated)
+        remaining -= used
+    return prepared
+
+
+def _group_summary_request(markdowns: List[str], events: List[Dict]) -> Dict:
+    """Build the messages.create params for a fused viewport/activity summary."""
     combined_content = "\n\n--- PAGE SEPARATOR ---\n\n".join(markdowns)
 
-    prompt = f"""Please create a concise viewport summary of the following web page content(s). 
-Focus on the main topics, key information, and overall purpose. Keep it under 150 words.
-
-Content from {len(markdowns)} page(s):
-{combined_content}
-"""
-
-    try:
-        response = client.messages.create(
-            model="claude-sonnet-4-20250514",
-            max_tokens=1000,
-            messages=[{"role": "user", "content": prompt}],
-        )
-        if response.content and len(response.content) > 0:
-            content_block = response.content[0]
-            if hasattr(content_block, "text"):
-                return content_block.text.strip()  # type: ignore
-            elif hasattr(content_block, "content"):
-                return str(content_block.content).strip()  # type: ignore
-            else:
-                return str(content_block).strip()
-        return f"Viewport summary of {len(markdowns)} page(s) - Error: No text content"
-    except Exception as e:
-        return f"Viewport summary of {len(markdowns)} page(s) - Error: {str(e)}"
-
-
-def analyze_tab_group_activity(events: List[Dict], viewport_summary: str) -> str:
-    client = get_anthropic_client()
-
     event_summary = []
-    for event in events:
+    for event in events[:MAX_EVENTS_PER_PROMPT]:
         event_type = event.get("type", "unknown")
         url = event.get("url", "")
         timestamp = event.get("timestamp", "")
         event_summary.append(f"- {event_type} on {url} at {timestamp}")
+    if len(events) > MAX_EVENTS_PER_PROMPT:
+        event_summary.append(
+            f"- ... {len(events) - MAX_EVENTS_PER_PROMPT} more events omitted"
+        )
 
     events_text = "\n".join(event_summary)
 
-    prompt = f"""Analyze this user browsing session and provide a concise activity summary (under 100 words).
-Focus on what the user was doing, their intent, and the nature of their interaction.
-
-Viewport Context: {viewport_summary}
+    prompt = f"""Content from {len(markdowns)} page(s):
+{combined_content}
 
 User Events:
 {events_text}
 """
 
+    return {
+        "model": SUMMARY_MODEL,
+        "max_tokens": SUMMARY_MAX_TOKENS,
+        "temperature": 0.0,
+        "messages": [
+            {
+                "role": "user",
+                "content": [
+                    {
+                        "type": "text",
+                        "text": SUMMARIZE_GROUP_INSTRUCTIONS,
+                        "cache_control": {"type": "ephemeral"},
+                    },
+                    {"type": "text", "text": prompt},
+                ],
+            }
+        ],
+        "tools": [SUMMARIZE_GROUP_TOOL],
+        "tool_choice": {"type": "tool", "name": "summarize_group"},
+    }
+
+
+def _group_summary_cache_key(markdowns: List[str], events: List[Dict]) -> str:
+    # Response cache keys hash the prompt's inputs, so revisited pages with
+    # repeated activity patterns skip the API call, within and across runs.
+    # Timestamps and URL paths are left out on purpose: the same kind of
+    # interaction on the same sites gets the same summary.
+    combined_content = "\n\n--- PAGE SEPARATOR ---\n\n".join(markdowns)
+    signature = "\n".join(
+        f"{event.get('type', 'unknown')} {get_base_url(event.get('url', ''))}"
+        for event in events
+    )
+    digest = hashlib.sha1(f"{combined_content}\n{signature}".encode()).hexdigest()
+    return f"group:{SUMMARY_MODEL}:{digest}"
+
+
+def _parse_group_summary(response: Message) -> Optional[Tuple[str, str]]:
+    """Extract (viewport, activity) from a summarize_group tool call."""
     try:
-        response = client.messages.create(
-            model="claude-sonnet-4-20250514",
-            max_tokens=1000,
-            messages=[{"role": "user", "content": prompt}],
-        )
-        if response.content and len(response.content) > 0:
-            content_block = response.content[0]
-            if hasattr(content_block, "text"):
-                return content_block.text.strip()  # type: ignore
-            elif hasattr(content_block, "content"):
-                return str(content_block.content).strip()  # type: ignore
-            else:
-                return str(content_block).strip()
-        return f"Activity summary: {len(events)} events - Error: No text content"
-    except Exception as e:
+        result = response.content[0].input  # type: ignore
+        return result["viewport"].strip(), result["activity"].strip()  # type: ignore
+    except (AttributeError, IndexError, KeyError, TypeError):
+        return None
+
+
+def _finish_group_summary(
+    markdowns: List[str],
+    events: List[Dict],
+    summary: Optional[Tuple[str, str]],
+    error: str,
+) -> Tuple[str, str]:
+    """Fill in error summaries and the no-content viewport."""
+    if summary is None:
         event_types = [event.get("type", "") for event in events]
-        return f"Activity summary: {len(events)} events ({', '.join(set(event_types))}) - Error: {str(e)}"
+        summary = (
+            f"Viewport summary of {len(markdowns)} page(s) - Error: {error}",
+            f"Activity summary: {len(events)} events ({', '.join(set(event_types))}) - Error: {error}",
+        )
+    if not markdowns:
+        return "No content available", summary[1]
+    return summary
 
 
-def create_tab_group_summary(
-    group_events: List[Dict], tab_markdowns: Dict[int, str]
-) -> Optional[TabSessionSummary]:
+async def summarize_group(markdowns: List[str], events: List[Dict]) -> Tuple[str, str]:
     """
-    Creates a TabGroupSummary from a group of events.
+    Summarize a tab group's page content and user activity in a single call.
 
-    Args:
-        group_events: List of events in this tab group
-        tab_markdowns: Dictionary mapping tab_id to most recent markdown content
+    Returns:
+        Tuple of (viewport summary, activity summary)
     """
-    if not group_events:
-        return None
+    markdowns = _prepare_markdowns(markdowns)
+    cache_key = _group_summary_cache_key(markdowns, events)
+    cached = get_cached_response(cache_key)
+    if cached is not None:
+        viewport, activity = json.loads(cached)
+        return viewport, activity
 
-    # Get base URL from first event (should be page-load or tab-switch)
-    first_event = group_events[0]
-    base_url = get_base_url(first_event.get("url", ""))
-    tab_id = first_event.get("tabId")
-
-    # Collect markdowns from page-load events in this group
-    markdowns = []
-    for event in group_events:
-        if event.get("type") == "page-load":
-            markdown = event.get("payload", {}).get("markdown", "")
-            if markdown:
-                markdowns.append(markdown)
+    try:
+        response = await create_message(**_group_summary_request(markdowns, events))
+    except Exception as e:
+        return _finish_group_summary(markdowns, events, None, str(e))
+
+    summary = _parse_group_summary(response)
+    if summary is not None:
+        set_cached_response(cache_key, json.dumps(summary))
+    return _finish_group_summary(markdowns, events, summary, "No summary returned")
+
+
+@dataclass
+class TabGroup:
+    """A tab group as a [start, end) slice of the event stream."""
+
+    start: int
+    end: int
+    tab_id: Optional[int]
+    page_load_idxs: List[int]  # Indices of the group's page-load events
+    fallback_markdown: Optional[str] = None  # Tab's last markdown when closed
+
+
+@dataclass
+class EventColumns:
+    """Struct-of-arrays view of the event fields that grouping reads."""
+
+    types: List[str]
+    urls: List[str]
+    tab_ids: List[Optional[int]]
+    markdowns: List[str]  # Page-load markdown, "" for every other event
+
+
+def _event_columns(events: List[Dict]) -> EventColumns:
+    types = [event.get("type", "") for event in events]
+    return EventColumns(
+        types=types,
+        urls=[event.get("url", "") for event in events],
+        tab_ids=[event.get("tabId") for event in events],
+        markdowns=[
+            (
+                event.get("payload", {}).get("markdown", "")
+                if event_type == "page-load"
+                else ""
+            )
+            for event, event_type in zip(events, types)
+        ],
+    )
+
+
+def _collect_group_markdowns(columns: EventColumns, group: TabGroup) -> List[str]:
+    """Collect the page-load markdowns a group's viewport summary is built from."""
+    markdowns = [
+        columns.markdowns[idx] for idx in group.page_load_idxs if columns.markdowns[idx]
+    ]
 
     # If no markdowns in group (e.g., started with tab-switch), use tab's last known markdown
-    if not markdowns and tab_id and tab_id in tab_markdowns:
-        markdowns.append(tab_markdowns[tab_id])
+    if not markdowns and group.fallback_markdown:
+        markdowns.append(group.fallback_markdown)
 
-    # Create summaries using placeholder functions
-    viewport_summary = summarize_markdowns(markdowns)
-    activity_summary = analyze_tab_group_activity(group_events, viewport_summary)
+    return markdowns
+
+
+def _build_tab_session_summary(
+    columns: EventColumns,
+    group: TabGroup,
+    viewport_summary: str,
+    activity_summary: str,
+) -> TabSessionSummary:
+    # Get base URL from first event (should be page-load or tab-switch)
+    base_url = get_base_url(columns.urls[group.start])
 
     return TabSessionSummary(
         url=base_url or "Unknown",
         viewport=viewport_summary,
         activity_summary=activity_summary,
-        events_count=len(group_events),
-        tab_id=tab_id,
+        events_count=group.end - group.start,
+        tab_id=group.tab_id,
+        event_types=set(columns.types[group.start : group.end]),
+    )
+
+
+async def create_tab_group_summary(
+    events: List[Dict], columns: EventColumns, group: TabGroup
+) -> Optional[TabSessionSummary]:
+    """
+    Creates a TabGroupSummary from a group of events.
+
+    Args:
+        events: Full event stream the group indexes into
+        columns: Column-wise view of the same events
+        group: Boundaries and page-load indices of this tab group
+    """
+    if group.start >= group.end:
+        return None
+
+    markdowns = _collect_group_markdowns(columns, group)
+    group_events = events[group.start : group.end]
+
+    viewport_summary, activity_summary = await summarize_group(markdowns, group_events)
+
+    return _build_tab_session_summary(
+        columns, group, viewport_summary, activity_summary
+    )
+
+
+async def summarize_tab_groups_batch(
+    events: List[Dict],
+    columns: EventColumns,
+    groups: List[TabGroup],
+    semaphore: asyncio.Semaphore,
+) -> List[TabSessionSummary]:
+    """
+    Summarize tab groups through the Message Batches API.
+
+    Every group not already in the response cache becomes one request of a
+    single batch, instead of one realtime request per group. Groups whose
+    batch request errored or expired are summarized in realtime instead,
+    bounded by `semaphore`.
+
+    Args:
+        events: Full event stream the groups index into
+        columns: Column-wise view of the same events
+        groups: Tab groups, as produced by group_events_into_tab_sessions
+        semaphore: Limits the realtime requests for failed batch entries
+    """
+    groups = [group for group in groups if group.start < group.end]
+    group_markdowns = [
+        _prepare_markdowns(_collect_group_markdowns(columns, group)) for group in groups
+    ]
+    group_events = [events[group.start : group.end] for group in groups]
+
+    cache_keys = [
+        _group_summary_cache_key(group_markdowns[i], group_events[i])
+        for i in range(len(groups))
+    ]
+    cached = [get_cached_response(key) for key in cache_keys]
+
+    messages = await run_message_batch(
+        [
+            {
+                "custom_id": str(i),
+                "params": _group_summary_request(group_markdowns[i], group_events[i]),
+            }
+            for i in range(len(groups))
+            if cached[i] is None
+        ]
     )
 
+    async def resolve(i: int) -> TabSessionSummary:
+        markdowns, events_slice = group_markdowns[i], group_events[i]
+        if cached[i] is not None:
+            viewport, activity = json.loads(cached[i])  # type: ignore
+            summary = (viewport, activity)
+        else:
+            message = messages.get(str(i))
+            summary = _parse_group_summary(message) if message else None
+            if summary is not None:
+                set_cached_response(cache_keys[i], json.dumps(summary))
+
+        if summary is None:
+            # The batch entry errored or expired; preparing the markdowns
+            # again inside summarize_group leaves them unchanged
+            async with semaphore:
+                viewport, activity = await summarize_group(markdowns, events_slice)
+        else:
+            viewport, activity = _finish_group_summary(
+                markdowns, events_slice, summary, ""
+            )
+        return _build_tab_session_summary(columns, groups[i], viewport, activity)
+
+    return list(await asyncio.gather(*[resolve(i) for i in range(len(groups))]))
+
 
-def group_events_into_tab_sessions(events) -> List[TabSessionSummary]:
+async def group_events_into_tab_sessions(
+    events, realtime: bool = False
+) -> List[TabSessionSummary]:
     """
     Group browser events into tab sessions based on URL changes and tab switches.
 
+    Groups are delimited in a single pass that records their boundaries and
+    page-load indices. Their summaries then go through the Message Batches
+    API, or are requested concurrently (bounded by MAX_CONCURRENT_REQUESTS)
+    when realtime is set or there are too few groups for a batch to pay off.
+
     Returns:
         List of TabSessionSummary objects representing grouped sessions
     """
-    tab_groups = []
-    current_group = []
+    # Grouping only ever reads a few fields, so pull them into columns once
+    # instead of doing repeated dict lookups per event
+    columns = _event_columns(events)
+    types, urls, tab_ids = columns.types, columns.urls, columns.tab_ids
+
+    groups: List[TabGroup] = []
+    group_start: Optional[int] = None  # None while no group is open
+    page_load_idxs: List[int] = []
     current_base_url = None
     tab_markdowns = {}  # Track markdowns by tab_id
 
-    for event in events:
-        event_type = event.get("type", "")
-
-        # Update tab markdowns when we see page-load events
+    def close_group(end: int):
+        if group_start is not None:
+            tab_id = tab_ids[group_start]
+            groups.append(
+                TabGroup(
+                    start=group_start,
+                    end=end,
+                    tab_id=tab_id,
+                    page_load_idxs=page_load_idxs,
+                    fallback_markdown=tab_markdowns.get(tab_id) if tab_id else None,
+                )
+            )
+
+    for i, event_type in enumerate(types):
         if event_type == "page-load":
-            tab_id = event.get("tabId")
-            markdown = event.get("payload", {}).get("markdown", "")
+            # Update tab markdowns when we see page-load events
+            tab_id = tab_ids[i]
+            markdown = columns.markdowns[i]
             if tab_id and markdown:
                 tab_markdowns[tab_id] = markdown
 
-        if event_type == "page-load":
-            event_base_url = get_base_url(event.get("url", ""))
+            event_base_url = get_base_url(urls[i])
 
             # Only start new group if base URL changed
             if event_base_url != current_base_url:
                 # Save current group before starting new one
-                if current_group:
-                    summary = create_tab_group_summary(current_group, tab_markdowns)
-                    if summary:
-                        tab_groups.append(summary)
-                current_group = [event]
+                close_group(i)
+                group_start = i
+                page_load_idxs = [i]
                 current_base_url = event_base_url
             else:
                 # Same base URL, just add to current group
-                current_group.append(event)
+                if group_start is None:
+                    group_start = i
+                page_load_idxs.append(i)
 
         elif event_type == "tab-switch":
             # Save current group before starting new one
-            if current_group:
-                summary = create_tab_group_summary(current_group, tab_markdowns)
-                if summary:
-                    tab_groups.append(summary)
+            close_group(i)
             # Start new group with this tab-switch event
-            current_group = [event]
+            group_start = i
+            page_load_idxs = []
             # Reset base URL tracking since we switched tabs
             current_base_url = None
 
         elif event_type == "tab-removal":
-            # Save current group before ending
-            if current_group:
-                summary = create_tab_group_summary(current_group, tab_markdowns)
-                if summary:
-                    tab_groups.append(summary)
-            current_group = []
+            # Save current group before ending; the removal itself is dropped
+            close_group(i)
+            group_start = None
+            page_load_idxs = []
             current_base_url = None
 
-        else:
-            # Regular events (click, type, copy, paste, highlight)
-            current_group.append(event)
-
-    if current_group:
-        summary = create_tab_group_summary(current_group, tab_markdowns)
-        if summary:
-            tab_groups.append(summary)
-
-    return tab_groups
+        elif group_start is None:
+            # Regular events (click, type, copy, paste, highlight) open a group
+            # if none is active
+            group_start = i
+
+    close_group(len(events))
+
+    semaphore = asyncio.Semaphore(MAX_CONCURRENT_REQUESTS)
+    results: Optional[List[TabSessionSummary]] = None
+    if not realtime and len(groups) >= BATCH_MIN_REQUESTS:
+        try:
+            results = await summarize_tab_groups_batch(
+                events, columns, groups, semaphore
+            )
+        except Exception:
+            logger.exception("Batch summarization failed, retrying in realtime")
+
+    if results is None:
+
+        async def summarize(group: TabGroup):
+            async with semaphore:
+                return await create_tab_group_summary(events, columns, group)
+
+        summaries = await asyncio.gather(*[summarize(group) for group in groups])
+        results = [summary for summary in summaries if summary]
+
+    for i, summary in enumerate(results):
+        logger.debug(
+            "group %d url=%s tab=%s events=%d",
+            i,
+            summary.url,
+            summary.tab_id,
+            summary.events_count,
+        )
+    return results
@@ -1,39 +1,37 @@
 """Module for processing tab sessions to identify workflows."""
 
-from typing import List, Tuple, Optional
+import asyncio
+from typing import Dict, List, Tuple, Optional
+from urllib.parse import urlsplit
 from .shared_types import (
+    CLASSIFIER_MODEL,
+    MAX_CONCURRENT_REQUESTS,
     TabSessionSummary,
     Workflow,
     WorkflowStep,
     DeterminerResponse,
-    get_anthropic_client,
+    create_message,
 )
 
-
-def is_workflow(
-    window: List[TabSessionSummary],
-) -> Tuple[DeterminerResponse, Optional[Workflow]]:
-    """
-    Use AI to determine if a window of tab sessions constitutes a workflow.
-    """
-    client = get_anthropic_client()
-
-    # Build session descriptions
-    session_descriptions = []
-    for i, session in enumerate(window):
-        session_descriptions.append(
-            f"Session {i+1}: {session.url}\n"
-            f"  Page content: {session.viewport}\n"
-            f"  User activity: {session.activity_summary}\n"
-            f"  Events: {session.events_count}"
-        )
-
-    sessions_text = "\n\n".join(session_descriptions)
-
-    prompt = f"""Analyze this sequence of browser sessions to determine if they constitute a complete workflow, are just noise/random browsing, or are part of an unfinished workflow.
-
-BROWSER SESSIONS TO ANALYZE:
-{sessions_text}
+# Social/entertainment sites: a window that only browses these without any
+# input events is classified as noise without calling Claude
+NOISE_DOMAINS = {
+    "youtube.com",
+    "twitter.com",
+    "x.com",
+    "reddit.com",
+    "facebook.com",
+    "instagram.com",
+    "tiktok.com",
+    "netflix.com",
+    "twitch.tv",
+    "pinterest.com",
+}
+INPUT_EVENT_TYPES = {"type", "copy", "paste"}
+
+# Static prompt prefix and tool schema, kept byte-identical across calls so
+# Anthropic's prompt cache can reuse them; the sessions are appended last.
+WORKFLOW_INSTRUCTIONS = """Analyze this sequence of browser sessions to determine if they constitute a complete workflow, are just noise/random browsing, or are part of an unfinished workflow.
 
 WORKFLOW DEFINITION:
 A workflow is a coherent sequence of browser activities that accomplish a SPECIFIC, ACTIONABLE goal. The user must be actively working toward something concrete, not just browsing or consuming content.
@@ -76,81 +74,150 @@ CRITICAL WORKFLOW REQUIREMENTS:
 BE VERY STRICT: If the user is just browsing, reading, or "accessing" things without clear productive action, it is NOT a workflow. 
 Workflows must tell a story of purposeful work toward a specific outcome. It is possible that within a workflow there is intermittemnt noise, so if there is ANY logical buildup happening, classify as UNFINISHED."""
 
-    response = client.messages.create(
-        model="claude-sonnet-4-20250514",
-        max_tokens=2000,
-        messages=[{"role": "user", "content": prompt}],
-        tools=[
-            {
-                "name": "classify_workflow",
-                "description": "Classify the browser sessions as workflow, noise, or unfinished",
-                "input_schema": {
+CLASSIFY_WORKFLOW_TOOL = {
+    "name": "classify_workflow",
+    "description": "Classify the browser sessions as workflow, noise, or unfinished",
+    "input_schema": {
+        "type": "object",
+        "properties": {
+            "classification": {
+                "type": "string",
+                "enum": ["workflow", "noise", "unfinished"],
+                "description": "Whether this is a complete workflow, noise, or unfinished workflow",
+            },
+            "reasoning": {
+                "type": "string",
+                "description": "Reasoning for this classification decision",
+            },
+            "workflow_summary": {
+                "type": "string",
+                "description": "If classification is 'workflow', provide a clear summary of what the workflow accomplishes. Leave empty for noise/unfinished.",
+            },
+            "workflow_steps": {
+                "type": "array",
+                "description": "If classification is 'workflow', break down into logical steps. Leave empty for noise/unfinished.",
+                "items": {
                     "type": "object",
                     "properties": {
-                        "classification": {
+                        "description": {
                             "type": "string",
-                            "enum": ["workflow", "noise", "unfinished"],
-                            "description": "Whether this is a complete workflow, noise, or unfinished workflow",
-                        },
-                        "reasoning": {
-                            "type": "string",
-                            "description": "Reasoning for this classification decision",
-                        },
-                        "workflow_summary": {
-                            "type": "string",
-                            "description": "If classification is 'workflow', provide a clear summary of what the workflow accomplishes. Leave empty for noise/unfinished.",
-                        },
-                        "workflow_steps": {
-                            "type": "array",
-                            "description": "If classification is 'workflow', break down into logical steps. Leave empty for noise/unfinished.",
-                            "items": {
-                                "type": "object",
-                                "properties": {
-                                    "description": {
-                                        "type": "string",
-                                        "description": "What happens in this step",
-                                    }
-                                },
-                                "required": ["description"],
-                            },
-                        },
+                            "description": "What happens in this step",
+                        }
                     },
-                    "required": ["classification", "reasoning"],
+                    "required": ["description"],
                 },
-            }
-        ],
-        tool_choice={"type": "tool", "name": "classify_workflow"},
+            },
+        },
+        "required": ["classification", "reasoning"],
+    },
+    "cache_control": {"type": "ephemeral"},
+}
+
+
+def _is_noise_domain(url: str) -> bool:
+    host = urlsplit(url).hostname or ""
+    return any(
+        host == domain or host.endswith("." + domain) for domain in NOISE_DOMAINS
     )
 
-    tool_use = response.content[0]
-    result = tool_use.input  # type: ignore
 
-    classification = result["classification"]  # type: ignore
+def _is_obvious_noise(window: List[TabSessionSummary]) -> bool:
+    """Whether the window is passive browsing of social/entertainment sites only."""
+    return all(
+        _is_noise_domain(session.url)
+        and not (session.event_types and session.event_types & INPUT_EVENT_TYPES)
+        for session in window
+    )
+
+
+def _parse_classification(
+    result: Dict,
+) -> Tuple[DeterminerResponse, Optional[Workflow]]:
+    """
+    Validate a classify_workflow tool input and convert it in one pass.
+
+    Unknown or missing classifications are treated as UNFINISHED, and steps
+    without a description are dropped.
+    """
+    try:
+        classification = DeterminerResponse(result.get("classification"))
+    except ValueError:
+        return (DeterminerResponse.UNFINISHED, None)
 
-    if classification == "workflow":
-        workflow_summary = result.get("workflow_summary", "")  # type: ignore
-        workflow_steps_data = result.get("workflow_steps", [])  # type: ignore
+    if classification != DeterminerResponse.WORKFLOW:
+        return (classification, None)
 
-        steps = []
-        for step_data in workflow_steps_data:
-            steps.append(WorkflowStep(description=step_data["description"]))  # type: ignore
+    steps = [
+        WorkflowStep(description=step_data["description"])
+        for step_data in result.get("workflow_steps") or []
+        if isinstance(step_data, dict) and step_data.get("description")
+    ]
+    workflow = Workflow(summary=result.get("workflow_summary") or "", steps=steps)
+    return (DeterminerResponse.WORKFLOW, workflow)
 
-        workflow = Workflow(summary=workflow_summary, steps=steps)
-        return (DeterminerResponse.WORKFLOW, workflow)
 
-    elif classification == "noise":
+async def is_workflow(
+    window: List[TabSessionSummary],
+) -> Tuple[DeterminerResponse, Optional[Workflow]]:
+    """
+    Use AI to determine if a window of tab sessions constitutes a workflow.
+    """
+    if _is_obvious_noise(window):
         return (DeterminerResponse.NOISE, None)
 
-    else:
-        return (DeterminerResponse.UNFINISHED, None)
+    # One content block per session, so a window that grows by one session
+    # shares its whole prefix with the previous, already cached, request
+    content: List[Dict] = [
+        {
+            "type": "text",
+            "text": WORKFLOW_INSTRUCTIONS,
+            "cache_control": {"type": "ephemeral"},
+        },
+        {"type": "text", "text": "BROWSER SESSIONS TO ANALYZE:"},
+    ]
+    for i, session in enumerate(window):
+        content.append(
+            {
+                "type": "text",
+                "text": f"Session {i+1}: {session.url}\n"
+                f"  Page content: {session.viewport}\n"
+                f"  User activity: {session.activity_summary}\n"
+                f"  Events: {session.events_count}",
+            }
+        )
+    content[-1]["cache_control"] = {"type": "ephemeral"}
+
+    response = await create_message(
+        model=CLASSIFIER_MODEL,
+        max_tokens=2000,
+        messages=[{"role": "user", "content": content}],  # type: ignore
+        tools=[CLASSIFY_WORKFLOW_TOOL],  # type: ignore
+        tool_choice={"type": "tool", "name": "classify_workflow"},
+    )
+
+    tool_use = response.content[0]
+    return _parse_classification(tool_use.input)  # type: ignore
+
 
+def _is_decided(response: DeterminerResponse) -> bool:
+    return response in (DeterminerResponse.WORKFLOW, DeterminerResponse.NOISE)
 
-def process_workflows_from_tab_sessions(
+
+async def process_workflows_from_tab_sessions(
     tab_sessions: List[TabSessionSummary],
 ) -> List[Workflow]:
     """
     Process tab sessions to identify complete workflows using sliding window approach.
 
+    From each left edge, every window size is classified smallest-first and
+    the first WORKFLOW or NOISE verdict wins. A verdict can flip back to
+    UNFINISHED once a window runs into the next workflow, so no size is
+    skipped. Sizes are launched in rounds that end at sizes 1, 2, 4, 8, ...
+    (the rest of the sessions ending the last round); a round's windows are
+    classified in parallel (at most MAX_CONCURRENT_REQUESTS requests at a
+    time) and read smallest-first, and windows past the first decided one are
+    cancelled. A boundary N sessions out is thus found in O(log N) rounds.
+
     Args:
         tab_sessions: List of tab session summaries to analyze
 
@@ -159,29 +226,51 @@ def process_workflows_from_tab_sessions(
     """
     workflows = []
     left = 0
+    semaphore = asyncio.Semaphore(MAX_CONCURRENT_REQUESTS)
 
-    while left < len(tab_sessions):
-        right = left + 1
+    async def bounded_is_workflow(
+        window: List[TabSessionSummary],
+    ) -> Tuple[DeterminerResponse, Optional[Workflow]]:
+        async with semaphore:
+            return await is_workflow(window)
 
-        while right <= len(tab_sessions):
-            current_window = tab_sessions[left:right]
-            response, workflow = is_workflow(current_window)
-
-            if response == DeterminerResponse.WORKFLOW:
-                if workflow:
-                    workflows.append(workflow)
-                left = right  # Move past this workflow
-                break
-
-            elif response == DeterminerResponse.NOISE:
-                left = right  # Move past this noise
-                break
-
-            else:
-                right += 1
-
-        # If we reach here without breaking, we've hit the end with an unfinished workflow
-        if right > len(tab_sessions):
+    while left < len(tab_sessions):
+        decided = None  # Smallest right edge with a verdict
+        workflow = None
+        right = left  # Largest right edge classified so far
+        size = 1
+
+        while decided is None and right < len(tab_sessions):
+            # This round covers the windows up to the next power-of-two size
+            round_end = min(left + size, len(tab_sessions))
+            rights = list(range(right + 1, round_end + 1))
+            tasks = [
+                asyncio.create_task(bounded_is_workflow(tab_sessions[left:r]))
+                for r in rights
+            ]
+
+            try:
+                for r, task in zip(rights, tasks):
+                    response, workflow = await task
+                    if _is_decided(response):
+                        decided = r
+                        break
+            finally:
+                # Drop speculative requests whose verdict is no longer needed
+                for task in tasks:
+                    if not task.done():
+                        task.cancel()
+                await asyncio.gather(*tasks, return_exceptions=True)
+
+            right = round_end
+            size *= 2
+
+        # If no window is decided, we've hit the end with an unfinished workflow
+        if decided is None:
             break
 
+        if response == DeterminerResponse.WORKFLOW and workflow:
+            workflows.append(workflow)
+        left = decided  # Move past this workflow or noise
+
     return workflows